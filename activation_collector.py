@@ -1,20 +1,32 @@
 """
 Collects CLT latent activations for specific InterPro families.
 
-Output Format: .npz files containing:
-  - 'activations': A NumPy object array of shape (N_SEQS,). 
-                   Each element is a float32 array of shape (N_LAYERS, SEQ_LEN, D_HIDDEN).
-  - 'entries': Array of UniProt Entry IDs.
-  - 'sequences': Array of protein sequences.
+Output Format: per group, a raw '<name>.bin' file plus a '<name>.json' manifest:
+  - '<name>.bin': All sequences' int16 latent indices, then all float16 values,
+                  each sequence stored as a C-order (SEQ_LEN, N_LAYERS, K) block.
+                  indices hold the ids of the TopK latents active at each position,
+                  values the matching activations (all other latents are zero).
+  - '<name>.json': {"d_hidden": D_HIDDEN,
+                    "entries": {UniProt Entry: {"sequence": str,
+                                                "indices": {"offset", "shape", "dtype"},
+                                                "values": {"offset", "shape", "dtype"}}}}
+  Offsets are in bytes into the .bin, so a reader can np.memmap a single
+  sequence without loading (or decompressing) anything else.
 
 Note: No max-pooling or mean-pooling is applied. Full latent sequences are saved.
 """
 
 import sys
 import os
+import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
 import numpy as np
 import polars as pl
 import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
 import click
 from tqdm import tqdm
 
@@ -24,87 +36,479 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
 from clt_module import CLTLightningModule
 from sae_module import get_esm_model
 
-def get_latents_for_batch(clt, esm_model, batch_seqs, device, k_value):
+try:
+    from flash_attn import flash_attn_varlen_func
+except ImportError:
+    flash_attn_varlen_func = None
+
+def length_bucketed_batches(seqs, token_budget, pad_multiple=8):
     """
-    Runs inference and returns full latents for all layers.
-    Returns: List of numpy arrays [ (Layers, Seq_Len_1, D_Hidden), (Layers, Seq_Len_2, D_Hidden), ... ]
+    Groups sequences of similar length so each batch carries little padding.
+    Sequences are visited shortest-first and packed until the padded batch
+    (n_seqs * padded_len, BOS/EOS included) would exceed token_budget.
+    A single sequence longer than the budget still gets its own batch.
+    Yields: List of indices into seqs, one list per batch.
     """
-    n_layers = clt.num_layers
-    batch_size = len(batch_seqs)
-    
-    # We can't pre-allocate a rectangular tensor because sequence lengths vary within the batch
-    # We will collect layer outputs in a list first: [Layer0, Layer1, ...] 
-    # where LayerX is (Batch, Max_Seq_Len, D_Hidden)
-    layers_data = []
+    order = np.argsort([len(s) for s in seqs], kind="stable")
+    batch = []
+    for idx in order:
+        # Sorted ascending, so the current sequence sets the batch's padded length
+        padded_len = -(-(len(seqs[idx]) + 2) // pad_multiple) * pad_multiple
+        if batch and (len(batch) + 1) * padded_len > token_budget:
+            yield batch
+            batch = []
+        batch.append(int(idx))
+    if batch:
+        yield batch
+
+@functools.lru_cache(maxsize=None)
+def _token_table(alphabet):
+    """256-entry byte -> ESM token id lookup; characters outside the alphabet map to <unk>."""
+    table = np.full(256, alphabet.unk_idx, dtype=np.int64)
+    for tok, idx in alphabet.tok_to_idx.items():
+        if len(tok) == 1:
+            table[ord(tok)] = idx
+    return table
+
+def tokenize_packed(alphabet, seqs):
+    """
+    Tokenizes seqs with one table gather instead of ESM's per-residue dict lookups.
+    Sequences must be ASCII (non-ASCII raises UnicodeEncodeError rather than
+    silently turning into several multi-byte <unk> tokens).
+    Returns: int64 array of shape (N_Tokens,), [BOS, residues..., EOS] per sequence.
+    """
+    residues = _token_table(alphabet)[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+    offsets = np.concatenate([[0], np.cumsum([len(seq) + 2 for seq in seqs])])
+
+    tokens = np.empty(offsets[-1], dtype=np.int64)
+    is_residue = np.ones(offsets[-1], dtype=bool)
+    is_residue[offsets[:-1]] = False
+    is_residue[offsets[1:] - 1] = False
+    tokens[offsets[:-1]] = alphabet.cls_idx
+    tokens[offsets[1:] - 1] = alphabet.eos_idx
+    tokens[is_residue] = residues
+    return tokens
+
+def tokenize_padded(alphabet, seqs):
+    """
+    Same tokens as alphabet.get_batch_converter(), via the byte lookup table.
+    Returns: int64 array of shape (B, Max_Len + 2), padded with alphabet.padding_idx.
+    """
+    table = _token_table(alphabet)
+    tokens = np.full((len(seqs), max(map(len, seqs)) + 2), alphabet.padding_idx, dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        tokens[i, 0] = alphabet.cls_idx
+        tokens[i, 1:1 + len(seq)] = table[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+        tokens[i, 1 + len(seq)] = alphabet.eos_idx
+    return tokens
+
+def _rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+def _packed_layer_forward(layer, x, cu_seqlens, max_seqlen, cos, sin):
+    """
+    ESM TransformerLayer forward on packed tokens x of shape (N_Tokens, E).
+    Same math as TransformerLayer.forward, but attention goes through
+    flash_attn_varlen_func so each sequence only attends within itself.
+    """
+    attn = layer.self_attn
+    n_tokens = x.shape[0]
+
+    # Self-attention block
+    residual = x
+    h = layer.self_attn_layer_norm(x)
+    q = attn.q_proj(h).view(n_tokens, attn.num_heads, attn.head_dim)
+    k = attn.k_proj(h).view(n_tokens, attn.num_heads, attn.head_dim)
+    v = attn.v_proj(h).view(n_tokens, attn.num_heads, attn.head_dim)
+    if cos is not None:
+        # Rotary positions restart at 0 for every packed sequence
+        q = q * cos + _rotate_half(q) * sin
+        k = k * cos + _rotate_half(k) * sin
+
+    # flash-attn only runs in fp16/bf16
+    attn_dtype = q.dtype if q.dtype in (torch.float16, torch.bfloat16) else torch.bfloat16
+    h = flash_attn_varlen_func(
+        q.to(attn_dtype), k.to(attn_dtype), v.to(attn_dtype),
+        cu_seqlens_q=cu_seqlens, cu_seqlens_k=cu_seqlens,
+        max_seqlen_q=max_seqlen, max_seqlen_k=max_seqlen,
+        softmax_scale=attn.scaling,
+    )
+    h = attn.out_proj(h.to(x.dtype).reshape(n_tokens, attn.embed_dim))
+    x = residual + h
+
+    # Feed-forward block
+    residual = x
+    h = layer.final_layer_norm(x)
+    h = layer.fc2(F.gelu(layer.fc1(h)))
+    return residual + h
+
+def _packed_esm_layers(esm_model, batch_seqs, device, cu_seqlens, max_seqlen):
+    """
+    Runs ESM on the batch concatenated into one ragged sequence (no padding).
+    Yields: Tensor(N_Tokens, E) per layer, tokens ordered [BOS, residues, EOS] per sequence.
+    """
+    # 1. Prepare Packed Input
+    tokens = _to_device(tokenize_packed(esm_model.alphabet, batch_seqs), device)
+    # Position of each token within its own sequence (output_size avoids a device sync)
+    seq_starts = torch.repeat_interleave(cu_seqlens[:-1], cu_seqlens.diff(), output_size=tokens.shape[0])
+    positions = torch.arange(tokens.shape[0], device=device) - seq_starts
+
+    rot_emb = esm_model.layers[0].self_attn.rot_emb
+    cos = sin = None
+    if rot_emb is not None:
+        freqs = torch.outer(positions.float(), rot_emb.inv_freq.to(device).float())
+        emb = torch.cat((freqs, freqs), dim=-1)[:, None, :] # (N, 1, Head_Dim)
+        cos, sin = emb.cos(), emb.sin()
+
+    # 2. Run ESM Encoder
+    x = esm_model.embed_scale * esm_model.embed_tokens(tokens) # (N, E)
+
+    # 3. Iterate Layers
+    for layer in esm_model.layers:
+        x = _packed_layer_forward(layer, x, cu_seqlens, max_seqlen, cos, sin)
+        yield x
+
+def _padded_esm_layers(esm_model, batch_seqs, device):
+    """
+    Fallback when flash-attn is unavailable: regular padded ESM forward.
+    Yields the same packed Tensor(N_Tokens, E) per layer as _packed_esm_layers.
+    """
+    # 1. Prepare Batch Input
+    batch_tokens = torch.from_numpy(tokenize_padded(esm_model.alphabet, batch_seqs)).to(device)
+    padding_mask = batch_tokens == esm_model.padding_idx # (B, T)
+
+    # 2. Run ESM Encoder
+    x = esm_model.embed_scale * esm_model.embed_tokens(batch_tokens)
+    x = x.transpose(0, 1) # (T, B, E)
 
+    # 3. Iterate Layers
+    for layer in esm_model.layers:
+        # ESM Layer Forward
+        x, _ = layer(x, self_attn_padding_mask=padding_mask, need_head_weights=False)
+
+        # Drop pads: (B, T, E) -> (N_Tokens, E), still grouped per sequence
+        yield x.transpose(0, 1)[~padding_mask]
+
+def use_packed_forward(device):
+    """
+    The packed path needs flash-attn and an Ampere+ GPU (flash-attn 2 does not
+    run below compute capability 8.0).
+    """
+    device = torch.device(device)
+    return (
+        flash_attn_varlen_func is not None
+        and device.type == "cuda"
+        and torch.cuda.get_device_capability(device)[0] >= 8
+    )
+
+def check_packed_forward(esm_model, device, atol=5e-2, rtol=5e-2):
+    """
+    Startup check that _packed_layer_forward still matches TransformerLayer.forward:
+    asserts the layer features it doesn't implement are off, then compares one short
+    batch against _padded_esm_layers layer by layer (bf16, hence the loose tolerances).
+    """
+    # _packed_layer_forward is pre-LN attention without bias_k/bias_v or a zero-attention slot
+    for layer in esm_model.layers:
+        attn = layer.self_attn
+        assert attn.bias_k is None and attn.bias_v is None, "packed forward does not support bias_k/bias_v"
+        assert not attn.add_zero_attn, "packed forward does not support add_zero_attn"
+        assert hasattr(layer, "self_attn_layer_norm") and hasattr(layer, "final_layer_norm"), \
+            "packed forward expects pre-LN TransformerLayers"
+
+    batch_seqs = ["MKTAYIAKQRQISFVKSHFSRQ", "MSEQNLKVAVLGAAGGIGQALALLLKTQLPSGSELSLYDIAPVTPGVAVDLSH", "MGLSDGEWQ"]
+    token_lens = [len(seq) + 2 for seq in batch_seqs]
+    cu_seqlens = torch.tensor(np.concatenate([[0], np.cumsum(token_lens)]), dtype=torch.int32, device=device)
+
+    with torch.no_grad(), torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+        packed = _packed_esm_layers(esm_model, batch_seqs, device, cu_seqlens, max(token_lens))
+        padded = _padded_esm_layers(esm_model, batch_seqs, device)
+        for layer_idx, (packed_acts, padded_acts) in enumerate(zip(packed, padded)):
+            torch.testing.assert_close(
+                packed_acts.float(), padded_acts.float(), atol=atol, rtol=rtol,
+                msg=lambda m: f"Packed ESM forward diverges from the padded forward at layer {layer_idx}: {m}",
+            )
+
+_ENCODE_MIN_TOKENS = 256
+
+def _encode_bucket(n_tokens):
+    """
+    Rounds n_tokens up to a coarse bucket: at least _ENCODE_MIN_TOKENS, then four
+    steps per power of two (2^j * {1, 1.25, 1.5, 1.75}). The CUDA-graph encode then
+    records only a few dozen shapes over a run (instead of one per batch) while
+    spending at most 25% of its work on padding.
+    """
+    if n_tokens <= _ENCODE_MIN_TOKENS:
+        return _ENCODE_MIN_TOKENS
+    # A quarter of the largest power of two below n_tokens
+    step = 1 << (n_tokens.bit_length() - 3)
+    return -(-n_tokens // step) * step
+
+def topk_sparse(x, k):
+    """
+    Sparse counterpart of clt.topK_activation (ReLU over the top k entries of x):
+    returns only the k survivors instead of building the dense (..., D_Hidden) output.
+    Returns: (values, indices), each (..., K)
+    """
+    vals, idxs = torch.topk(x, k=k, dim=-1)
+    return F.relu(vals), idxs
+
+def stack_encoder_weights(clt):
+    """
+    Stacks the per-layer CLT encoder parameters so all layers encode in one batched matmul.
+    Sets on clt: W_enc_stacked (L, E, D_Hidden), b_enc_stacked (L, 1, D_Hidden)
+    (encoder bias folded into b_enc) and b_pre_stacked (L, 1, E).
+    """
     with torch.no_grad():
-        # 1. Prepare Batch Input
-        data = [("protein", seq) for seq in batch_seqs]
-        _, _, batch_tokens = esm_model.alphabet.get_batch_converter()(data)
-        batch_tokens = batch_tokens.to(device)
-        padding_mask = batch_tokens != esm_model.padding_idx # (B, T)
-
-        # 2. Run ESM Encoder
-        x = esm_model.embed_scale * esm_model.embed_tokens(batch_tokens)
-        x = x.transpose(0, 1) # (T, B, E)
-        
-        # 3. Iterate Layers
-        for layer_idx, layer in enumerate(esm_model.layers):
-            if layer_idx >= n_layers: break
+        clt.W_enc_stacked = torch.stack([encoder.weight.T.contiguous() for encoder in clt.encoders])
+        clt.b_enc_stacked = torch.stack([
+            clt.b_enc[l] + (encoder.bias if encoder.bias is not None else 0)
+            for l, encoder in enumerate(clt.encoders)
+        ]).unsqueeze(1)
+        clt.b_pre_stacked = torch.stack([clt.b_pre[l] for l in range(clt.num_layers)]).unsqueeze(1)
 
-            # ESM Layer Forward
-            x, _ = layer(x, self_attn_padding_mask=None, need_head_weights=False)
-            
-            # Prepare for CLT (B, T, E)
-            layer_acts = x.transpose(0, 1) 
-            
-            # CLT Forward (Encode & Activate)
-            # 1. Norm
-            x_l, _, _ = clt.LN(layer_acts)
-            x_l = x_l - clt.b_pre[layer_idx]
-            
-            # 2. Encoder
-            pre_acts = clt.encoders[layer_idx](x_l) + clt.b_enc[layer_idx]
-            
-            # 3. Activation (The "Latents")
-            latents = clt.topK_activation(pre_acts, k=k_value) # (B, T, D_Hidden)
-            
-            # Move to CPU immediately to save GPU memory
-            layers_data.append(latents.cpu())
+def _clt_encode(ln, layer_acts, b_pre, W_enc, b_enc, k):
+    """
+    CLT encode for all layers at once: LN -> subtract b_pre -> encoder -> + b_enc -> TopK.
+    layer_acts is (L, N, E); the L encoders run as one batched matmul.
+    On GPU it runs through _compiled_clt_encode().
+    Returns: (values float16, indices int16), each token-major (N, L, K), narrowed on
+             device before the D2H copy
+    """
+    # 1. Norm
+    x_l, _, _ = ln(layer_acts)
+    x_l = x_l - b_pre
 
-    # 4. Re-assemble into per-sequence arrays
-    # layers_data is List[Tensor(B, T, H)] of length L
-    
-    batch_results = []
+    # 2. Encoder
+    pre_acts = torch.baddbmm(b_enc, x_l, W_enc) # (L, N, D_Hidden)
+
+    # 3. Activation (The "Latents")
+    vals, idxs = topk_sparse(pre_acts, k)
+
+    # Token-major so each sequence is one contiguous block of rows on the host
+    vals = vals.to(torch.float16).transpose(0, 1).contiguous()
+    idxs = idxs.to(torch.int16).transpose(0, 1).contiguous()
+    return vals, idxs
+
+@functools.lru_cache(maxsize=None)
+def _compiled_clt_encode():
+    """
+    _clt_encode compiled so Inductor fuses the LN/bias epilogues; reduce-overhead
+    replays it as a CUDA graph. Built on first GPU use only, so the CPU fallback
+    never pays for compilation.
+    """
+    return torch.compile(_clt_encode, mode="reduce-overhead", fullgraph=False)
+
+# Reused pinned host buffers for the async D2H copy, keyed by (slot, dtype).
+# Batches alternate between two slots, so batch i+1's copy never lands in the
+# buffer batch i is still being scattered from.
+_host_buffers = {}
+
+def _pinned_buffer(slot, shape, dtype):
+    """Pinned (shape, dtype) view into the slot's buffer, grown when a batch needs more room."""
+    n_elems = int(np.prod(shape))
+    buf = _host_buffers.get((slot, dtype))
+    if buf is None or buf.numel() < n_elems:
+        buf = torch.empty(n_elems, dtype=dtype, pin_memory=True)
+        _host_buffers[(slot, dtype)] = buf
+    return buf[:n_elems].view(shape)
+
+def _to_device(array, device):
+    """Host -> device copy through pinned memory, so the host doesn't wait on queued GPU work."""
+    tensor = torch.from_numpy(array)
+    if torch.device(device).type == "cuda":
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
+
+def get_latents_for_batch(clt, esm_model, batch_seqs, device, k_value, out_indices, out_values, out_starts, slot=0):
+    """
+    Launches inference for a batch and returns a callable that writes its sparse TopK
+    latents for all layers into preallocated outputs packed along the token axis.
+    On GPU the latents come back through an async copy into pinned buffer `slot`;
+    call the returned function after launching the next batch (with the other slot)
+    so the copy and the per-sequence scatter overlap that batch's GPU work.
+    The batch is packed into one ragged token sequence (flash-attn varlen) so no
+    compute is spent on padding; falls back to a padded forward without flash-attn
+    or an Ampere+ GPU.
+    Expects stack_encoder_weights(clt) to have been called and esm_model.layers
+    truncated to clt.num_layers.
+    out_indices / out_values: int16 / float16 arrays of shape (Total_Len, Layers, K).
+    out_starts: Position of each batch sequence's first residue along Total_Len.
+    """
+    batch_size = len(batch_seqs)
+
+    # Each sequence occupies [BOS, residues..., EOS] in the packed token dimension
+    token_lens = [len(seq) + 2 for seq in batch_seqs]
+    offsets = np.concatenate([[0], np.cumsum(token_lens)])
     
-    for b_idx in range(batch_size):
-        # Determine valid sequence length for this protein
-        # esm_wrapper typically adds BOS and EOS. 
-        # If you want the core sequence (without BOS/EOS), use [1 : length-1]
-        # If you want full context, use [0 : length]
-        # Here we take the core sequence matching the input string length
-        seq_len = len(batch_seqs[b_idx])
+    # bf16 autocast on GPU: ESM and CLT matmuls run on tensor cores.
+    on_cuda = torch.device(device).type == "cuda"
+
+    with torch.no_grad(), torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=on_cuda):
+        if use_packed_forward(device):
+            cu_seqlens = _to_device(offsets.astype(np.int32), device)
+            layer_outputs = _packed_esm_layers(esm_model, batch_seqs, device, cu_seqlens, max(token_lens))
+        else:
+            layer_outputs = _padded_esm_layers(esm_model, batch_seqs, device)
+
+        # Collect layer outputs first: [Layer0, Layer1, ...] where LayerX is
+        # (N_Tokens, E), then encode them all together.
+        # Tokens are padded to a coarse bucket so the compiled graph sees few shapes;
+        # the zero tail is never read back. Each layer is written straight into one
+        # padded (L, N, E) buffer rather than stacked and then padded (two copies).
+        stacked_acts = None
+        for layer_idx, layer_acts in enumerate(layer_outputs):
+            if stacked_acts is None:
+                n_tokens, embed_dim = layer_acts.shape
+                n_padded = _encode_bucket(n_tokens)
+                stacked_acts = layer_acts.new_zeros((len(esm_model.layers), n_padded, embed_dim))
+            stacked_acts[layer_idx, :n_tokens] = layer_acts
+
+        # CLT Forward (Encode & Activate), per token on the packed (L, N, E) tensor.
+        encode = _compiled_clt_encode() if on_cuda else _clt_encode
+        vals, idxs = encode(
+            clt.LN, stacked_acts, clt.b_pre_stacked, clt.W_enc_stacked, clt.b_enc_stacked, k_value,
+        )
+
+        # Move to CPU (one copy per output instead of one per layer), dropping the bucket
+        # padding. Issued on the compute stream, so it is ordered before the next batch's
+        # CUDA-graph replay overwrites vals / idxs.
+        if on_cuda:
+            host_idxs = _pinned_buffer(slot, (n_tokens,) + idxs.shape[1:], idxs.dtype)
+            host_vals = _pinned_buffer(slot, (n_tokens,) + vals.shape[1:], vals.dtype)
+            host_idxs.copy_(idxs[:n_tokens], non_blocking=True)
+            host_vals.copy_(vals[:n_tokens], non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+        else:
+            host_idxs, host_vals, copied = idxs, vals, None
+
+    def scatter():
+        """Waits for the batch's copy, then re-assembles it into per-sequence rows."""
+        if copied is not None:
+            copied.synchronize()
+        # all_idxs / all_vals are (N, L, K)
+        all_idxs = host_idxs.numpy()
+        all_vals = host_vals.numpy()
+
+        # Residues sit between each sequence's BOS and EOS in the packed layout
+        for b_idx in range(batch_size):
+            start_idx = offsets[b_idx] + 1
+            seq_len = len(batch_seqs[b_idx])
+            out_start = out_starts[b_idx]
+            # One contiguous block copy per sequence
+            out_indices[out_start:out_start + seq_len] = all_idxs[start_idx:start_idx + seq_len]
+            out_values[out_start:out_start + seq_len] = all_vals[start_idx:start_idx + seq_len]
+
+    return scatter
+
+def save_activations(out_prefix, indices, values, offsets, d_hidden, entries, seqs):
+    """
+    Writes the packed latents raw to out_prefix + ".bin" (indices, then values) and a
+    JSON manifest with each entry's byte offset, shape and dtype to out_prefix + ".json".
+    """
+    with open(out_prefix + ".bin", "wb") as f:
+        indices.tofile(f)
+        values.tofile(f)
+
+    # Packed arrays are C-contiguous along the token axis, so each sequence's
+    # block starts at offsets[i] rows into its array
+    values_base = indices.nbytes
+    manifest = {"d_hidden": int(d_hidden), "entries": {}}
+    for i, (entry, seq) in enumerate(zip(entries, seqs)):
+        shape = [int(offsets[i + 1] - offsets[i])] + list(indices.shape[1:])
+        manifest["entries"][entry] = {
+            "sequence": seq,
+            "indices": {"offset": int(offsets[i]) * indices.strides[0], "shape": shape, "dtype": indices.dtype.str},
+            "values": {"offset": values_base + int(offsets[i]) * values.strides[0], "shape": shape, "dtype": values.dtype.str},
+        }
+
+    with open(out_prefix + ".json", "w") as f:
+        json.dump(manifest, f)
+
+def produce_groups(queue, parquet_path, target_ids, n_samples, token_budget):
+    """
+    Producer process: loads the parquet and, for each target, samples the
+    positive/negative groups and buckets them by length.
+    Puts (target_id, n_with, n_without, groups) on queue per target, where groups
+    is [(name, seqs, entries, batches), ...] (empty if the target has no matches),
+    then None when done. Counts are sent along so the consumer logs them when it
+    actually starts on the target.
+    """
+    try:
+        print(f"Loading data from {parquet_path}...")
+        df = pl.read_parquet(parquet_path)
         
-        # Note: batch_tokens has BOS at 0 and EOS at seq_len+1 (usually)
-        # We assume latents map 1:1 to tokens.
-        # Extracting indices 1 to seq_len+1 gives the residues.
-        start_idx = 1
-        end_idx = start_idx + seq_len
+        # Match all targets in a single pass: explode each row's InterPro ids and
+        # collect the Entries carrying each target, instead of one substring scan per target
+        hits = (
+            df.select("Entry", pl.col("InterPro").str.split(";").alias("ipr_id"))
+            .explode("ipr_id")
+            .filter(pl.col("ipr_id").is_in(target_ids))
+            .group_by("ipr_id")
+            .agg(pl.col("Entry"))
+        )
+        target_entries = {row["ipr_id"]: row["Entry"] for row in hits.iter_rows(named=True)}
         
-        # Stack layers for this sequence: (L, Seq_Len, H)
-        # layer_tensors[b_idx] is (T, H)
-        seq_layers = []
-        for l_idx in range(len(layers_data)):
-            # Slice the valid tokens
-            layer_act = layers_data[l_idx][b_idx, start_idx:end_idx, :]
-            seq_layers.append(layer_act)
+        # One boolean label column per target, built in a single pass; only the
+        # columns needed downstream are kept so the partitions stay small
+        df = df.select(
+            "Entry", "Sequence",
+            *[
+                pl.col("Entry").is_in(pl.Series(target_entries.get(tid, []), dtype=pl.String)).alias(f"has_{tid}")
+                for tid in target_ids
+            ],
+        )
+        
+        for target_id in target_ids:
+            # Filter Logic: split on the label in one pass instead of filter + ~filter
+            has_col = f"has_{target_id}"
+            group_in = group_out = df.clear()
+            for part in df.partition_by(has_col, maintain_order=True):
+                if part[has_col][0]:
+                    group_in = part
+                else:
+                    group_out = part
             
-        # Stack to (L, Seq_Len, H)
-        # Use float32 to save space if it was float64, but torch is usually float32/16
-        seq_array = torch.stack(seq_layers, dim=0).float().numpy()
-        batch_results.append(seq_array)
+            if len(group_in) == 0:
+                queue.put((target_id, len(group_in), len(group_out), []))
+                continue
+
+            # Handle cases with fewer samples than requested
+            n_in = min(len(group_in), n_samples)
+            n_out = min(len(group_out), n_samples)
             
-    return batch_results
+            # Sample with shuffling
+            df_in = group_in.sample(n=n_in, shuffle=True, seed=42)
+            df_out = group_out.sample(n=n_out, shuffle=True, seed=42)
+        
+            # Queue both Positive and Negative groups for this target
+            groups = []
+            for name, dataframe in [("positives", df_in), ("negatives", df_out)]:
+                seqs = dataframe["Sequence"].to_list()
+                entries = dataframe["Entry"].to_list()
+                batches = list(length_bucketed_batches(seqs, token_budget))
+                groups.append((name, seqs, entries, batches))
+            queue.put((target_id, len(group_in), len(group_out), groups))
+    finally:
+        queue.put(None)
+
+def receive_groups(queue, producer, poll_seconds=5):
+    """
+    Yields the producer's queued items until its None sentinel.
+    Raises if the producer dies without sending it (e.g. OOM-killed or segfaulted),
+    instead of blocking on the queue forever.
+    """
+    while True:
+        try:
+            item = queue.get(timeout=poll_seconds)
+        except Empty:
+            if not producer.is_alive():
+                raise RuntimeError(f"Data producer died with exit code {producer.exitcode}")
+            continue
+        if item is None:
+            return
+        yield item
 
 @click.command()
 @click.option("--clt-checkpoint", default="/usr/scratch/dtsui/CLT/interprot/interprot/results_clt_L6_dim5000_k128/checkpoints/clt-step=16000-val/loss=0.69.ckpt", type=click.Path(exists=True))
@@ -112,21 +516,30 @@ def get_latents_for_batch(clt, esm_model, batch_seqs, device, k_value):
 @click.option("--parquet-path",default="/usr/scratch/dtsui/CLT/ESM-CLT_base/nodes/data/swissprot_seqid30_75k_all_info_with_3di.parquet", type=click.Path(exists=True))
 @click.option("--output-dir", default="./activations_output")
 @click.option("--n-samples", default=50, help="Number of sequences to sample per group")
+@click.option("--token-budget", default=16384, help="Max padded tokens per batch (sequences are bucketed by length)")
 @click.option("--device", default="cuda")
-def main(clt_checkpoint, esm2_weight, parquet_path, output_dir, n_samples, device):
+def main(clt_checkpoint, esm2_weight, parquet_path, output_dir, n_samples, token_budget, device):
     
     os.makedirs(output_dir, exist_ok=True)
     
-    # --- 1. Load Data ---
-    print(f"Loading data from {parquet_path}...")
-    df = pl.read_parquet(parquet_path)
-    
-    if "InterPro" not in df.columns:
+    if "InterPro" not in pl.read_parquet_schema(parquet_path):
         raise ValueError("Parquet file missing 'InterPro' column")
         
     # Define targets (list of IDs to check)
     target_ids = ["IPR000786", "IPR011584"]
     
+    # --- 1. Load Data (in the background) ---
+    # The producer filters/samples/buckets every target while this process
+    # loads the models and runs the GPU on the groups it has already prepared.
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue(maxsize=2)
+    producer = ctx.Process(
+        target=produce_groups,
+        args=(queue, parquet_path, target_ids, n_samples, token_budget),
+        daemon=True,
+    )
+    producer.start()
+    
     # --- 2. Load Models ---
     print("Loading models...")
     module = CLTLightningModule.load_from_checkpoint(clt_checkpoint, map_location=device)
@@ -137,66 +550,79 @@ def main(clt_checkpoint, esm2_weight, parquet_path, output_dir, n_samples, devic
     esm_model = esm_model.to(device)
     esm_model.eval()
     
-    # --- 3. Process Each Target ID ---
+    # Only the first clt.num_layers ESM layers feed the CLT; drop the rest
+    # so their weights don't occupy GPU memory
+    esm_model.layers = esm_model.layers[:module.clt.num_layers]
+    if torch.device(device).type == "cuda":
+        torch.cuda.empty_cache()
     
-    for target_id in target_ids:
-        print(f"\n--- Processing Target: {target_id} ---")
-        
-        # Filter Logic
-        has_id = df["InterPro"].str.contains(target_id).fill_null(False)
-        
-        group_in = df.filter(has_id)
-        group_out = df.filter(~has_id)
-        
-        print(f"Found {len(group_in)} sequences WITH {target_id}")
-        print(f"Found {len(group_out)} sequences WITHOUT {target_id}")
-        
-        if len(group_in) == 0:
-            print(f"Skipping {target_id} (no matches found)")
-            continue
-
-        # Handle cases with fewer samples than requested
-        n_in = min(len(group_in), n_samples)
-        n_out = min(len(group_out), n_samples)
-        
-        # Sample with shuffling
-        df_in = group_in.sample(n=n_in, shuffle=True, seed=42)
-        df_out = group_out.sample(n=n_out, shuffle=True, seed=42)
+    stack_encoder_weights(module.clt)
     
-        # Process both Positive and Negative groups for this target
-        for name, dataframe in [("positives", df_in), ("negatives", df_out)]:
-            print(f"Processing {name} for {target_id} ({len(dataframe)} sequences)...")
-            
-            seqs = dataframe["Sequence"].to_list()
-            entries = dataframe["Entry"].to_list()
+    # Latent ids are stored as int16
+    d_hidden = module.clt.encoders[0].out_features
+    if d_hidden > np.iinfo(np.int16).max:
+        raise ValueError(f"CLT d_hidden={d_hidden} does not fit the int16 latent indices")
+    
+    if use_packed_forward(device):
+        check_packed_forward(esm_model, device)
+    
+    # --- 3. Process Each Group ---
+    # Saving runs on a writer thread so disk I/O overlaps the next group's GPU work
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending_saves = []
+        
+        for target_id, n_with, n_without, groups in receive_groups(queue, producer):
+            print(f"\n--- Processing Target: {target_id} ---")
+            print(f"Found {n_with} sequences WITH {target_id}")
+            print(f"Found {n_without} sequences WITHOUT {target_id}")
             
-            batch_size = 8 
-            all_latents_list = []
+            if not groups:
+                print(f"Skipping {target_id} (no matches found)")
+                continue
             
-            for i in tqdm(range(0, len(seqs), batch_size)):
-                batch = seqs[i : i + batch_size]
-                # Returns list of numpy arrays (L, T, H)
-                batch_results = get_latents_for_batch(module.clt, esm_model, batch, device, module.clt.k)
-                all_latents_list.extend(batch_results)
-                
-            # Fix for "could not broadcast" error:
-            # Explicitly create an object array of the correct size first, then fill it.
-            # This prevents NumPy from trying to be smart and creating a multidimensional array if shapes happen to align.
-            activations_obj = np.empty(len(all_latents_list), dtype=object)
-            for i, arr in enumerate(all_latents_list):
-                activations_obj[i] = arr
+            for name, seqs, entries, batches in groups:
+                print(f"Processing {name} for {target_id} ({len(seqs)} sequences)...")
             
-            out_file = os.path.join(output_dir, f"{name}_{target_id}.npz")
+                # Output is allocated once for the whole group; sequence lengths are
+                # known up front, so each batch writes straight into its slots.
+                offsets = np.concatenate([[0], np.cumsum([len(seq) for seq in seqs])]).astype(np.int64)
+                out_shape = (offsets[-1], module.clt.num_layers, module.clt.k)
+                out_indices = np.empty(out_shape, dtype=np.int16)
+                out_values = np.empty(out_shape, dtype=np.float16)
             
-            np.savez_compressed(
-                out_file, 
-                activations=activations_obj, 
-                entries=entries,
-                sequences=seqs
-            )
-            print(f"Saved to {out_file}")
-            if len(activations_obj) > 0:
-                print(f" - Example item shape: {activations_obj[0].shape} (Layers, Seq_Len, Hidden)")
+                # Batches are in length order; results land at each sequence's
+                # original offset so the output stays aligned with entries/seqs.
+                # Batch i is scattered only after batch i+1 has been launched, so its
+                # D2H copy and the host-side scatter overlap batch i+1's GPU work.
+                pending_scatter = None
+                for batch_num, batch_indices in enumerate(tqdm(batches)):
+                    batch = [seqs[j] for j in batch_indices]
+                    scatter = get_latents_for_batch(
+                        module.clt, esm_model, batch, device, module.clt.k,
+                        out_indices, out_values, offsets[batch_indices], slot=batch_num % 2,
+                    )
+                    if pending_scatter is not None:
+                        pending_scatter()
+                    pending_scatter = scatter
+                if pending_scatter is not None:
+                    pending_scatter()
+                
+                out_file = os.path.join(output_dir, f"{name}_{target_id}")
+                pending_saves.append(writer.submit(
+                    save_activations,
+                    out_file, out_indices, out_values, offsets,
+                    d_hidden, entries, seqs,
+                ))
+                print(f"Saving to {out_file}.bin / {out_file}.json")
+                print(f" - Packed shape: {out_shape} (Total_Len, Layers, K) for {len(seqs)} sequences")
+        
+        # Surface any write errors
+        for future in pending_saves:
+            future.result()
+    
+    producer.join()
+    if producer.exitcode != 0:
+        raise RuntimeError(f"Data producer failed with exit code {producer.exitcode}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""
+One-off converter from the old dense activation_collector output ('<name>.npz' with
+'activations' (N_LAYERS, SEQ_LEN, D_HIDDEN) float32 per sequence, 'entries' and
+'sequences') to the current '<name>.bin' + '<name>.json' sparse TopK format.
+
+The dense latents come from a TopK activation, so at most K entries per position are
+nonzero and taking the top K again recovers them exactly.
+"""
+
+import os
+import json
+import click
+import numpy as np
+
+def dense_to_topk(dense, k):
+    """
+    dense: (L, T, D_Hidden) latents with at most k nonzeros per (layer, position).
+    Returns: (indices int16, values float16), each token-major (T, L, K), sorted by
+             value like torch.topk.
+    """
+    order = np.argsort(-dense, axis=-1, kind="stable")[..., :k]
+    values = np.take_along_axis(dense, order, axis=-1)
+    if np.count_nonzero(dense) != np.count_nonzero(values):
+        raise ValueError(f"more than k={k} nonzero latents at some position")
+    return order.astype(np.int16).transpose(1, 0, 2), values.astype(np.float16).transpose(1, 0, 2)
+
+@click.command()
+@click.argument("npz_paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--output-dir", default="./activations_output")
+@click.option("--k", default=128, help="CLT TopK k (IPR001478.json was built with k=128)")
+def main(npz_paths, output_dir, k):
+    os.makedirs(output_dir, exist_ok=True)
+
+    for npz_path in npz_paths:
+        data = np.load(npz_path, allow_pickle=True)
+        entries = [str(entry) for entry in data["entries"]]
+        seqs = [str(seq) for seq in data["sequences"]]
+
+        sparse = [dense_to_topk(dense, k) for dense in data["activations"]]
+        d_hidden = data["activations"][0].shape[-1]
+        if d_hidden > np.iinfo(np.int16).max:
+            raise ValueError(f"d_hidden={d_hidden} does not fit the int16 latent indices")
+        indices = np.concatenate([idxs for idxs, _ in sparse])
+        values = np.concatenate([vals for _, vals in sparse])
+
+        # Same layout as activation_collector.save_activations
+        out_prefix = os.path.join(output_dir, os.path.splitext(os.path.basename(npz_path))[0])
+        with open(out_prefix + ".bin", "wb") as f:
+            indices.tofile(f)
+            values.tofile(f)
+
+        offsets = np.concatenate([[0], np.cumsum([len(idxs) for idxs, _ in sparse])])
+        values_base = indices.nbytes
+        manifest = {"d_hidden": int(d_hidden), "entries": {}}
+        for i, (entry, seq) in enumerate(zip(entries, seqs)):
+            shape = [int(offsets[i + 1] - offsets[i])] + list(indices.shape[1:])
+            manifest["entries"][entry] = {
+                "sequence": seq,
+                "indices": {"offset": int(offsets[i]) * indices.strides[0], "shape": shape, "dtype": indices.dtype.str},
+                "values": {"offset": values_base + int(offsets[i]) * values.strides[0], "shape": shape, "dtype": values.dtype.str},
+            }
+        with open(out_prefix + ".json", "w") as f:
+            json.dump(manifest, f)
+        print(f"{npz_path} -> {out_prefix}.bin / {out_prefix}.json ({len(entries)} sequences)")
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,61 @@
-import math
-import numpy as np
-
-data = np.load('positives_IPR000786.npz', allow_pickle=True)
-print("Arrays in file:", list(data.keys()))
-for key in data.keys():
-    print(f"  {key}: shape={data[key].shape}, dtype={data[key].dtype}")
-
-
 import json
+import click
+import numpy as np
 
-with open('IPR001478.json', 'r') as f:
-    ipr_data = json.load(f)
-feature_nodes = ipr_data['nodes']
-
-sequence = data['sequences'][0]
-activation = data['activations'][0]  # Dim: (Layers, Seq_Len, Latent_Size)
-
-# Store tuples: (layer, seq_pos, activation_value, latent_index)
-# Select features specified in IPR001478.json per layer
-activations_list = []
-for layer_idx in range(activation.shape[0]):
-    layer_key = str(layer_idx)
-    if layer_key not in feature_nodes:
-        continue
-    selected_indices = feature_nodes[layer_key]
-    for seq_idx in range(activation.shape[1]):
-        values = activation[layer_idx, seq_idx]
-        for latent_idx in selected_indices:
-            value = float(values[latent_idx])
-            if math.fabs(value) > 0:
-                activations_list.append([layer_idx, seq_idx, value, int(latent_idx)])
-
-# Save as JSON
-with open('activation_indices.json', 'w') as f:
-    json.dump(activations_list, f)
-print(sequence)
-
-print(f"Saved {len(activations_list)} activations to activation_indices.json")
-print(f"Format: [layer, seq_pos, activation_value, latent_index]")
\ No newline at end of file
+def load_array(bin_path, info):
+    """Zero-copy view of one array described by an activation_collector manifest record."""
+    return np.memmap(bin_path, dtype=info['dtype'], mode='r', offset=info['offset'], shape=tuple(info['shape']))
+
+@click.command()
+@click.option("--activations", default="activations_output/positives_IPR000786",
+              help="activation_collector output prefix (reads <prefix>.json and <prefix>.bin)")
+def main(activations):
+    with open(activations + '.json', 'r') as f:
+        manifest = json.load(f)
+    print("Sequences in file:", len(manifest['entries']))
+
+    with open('IPR001478.json', 'r') as f:
+        ipr_data = json.load(f)
+    feature_nodes = ipr_data['nodes']
+
+    # First sequence in the file
+    entry, record = next(iter(manifest['entries'].items()))
+    sequence = record['sequence']
+    # Sparse TopK latents of the first sequence, Dim: (Seq_Len, Layers, K)
+    # Only this sequence's bytes are mapped; nothing else is read
+    indices = load_array(activations + '.bin', record['indices'])  # latent ids
+    values = load_array(activations + '.bin', record['values'])    # matching activations
+    print(f"  {entry}: indices shape={indices.shape}, dtype={indices.dtype}")
+
+    # Store tuples: (layer, seq_pos, activation_value, latent_index)
+    # Select features specified in IPR001478.json per layer
+    # Gathered as per-layer NumPy columns, converted to Python lists once at the end
+    layer_col, pos_col, value_col, latent_col = [], [], [], []
+    for layer_idx in range(indices.shape[1]):
+        layer_key = str(layer_idx)
+        if layer_key not in feature_nodes:
+            continue
+        selected_indices = feature_nodes[layer_key]
+        # Only the K active latents per position are stored, so match those against the selection
+        layer_indices = indices[:, layer_idx]  # (Seq_Len, K)
+        layer_values = values[:, layer_idx]
+        mask = np.isin(layer_indices, selected_indices) & (layer_values != 0)
+        seq_pos, slots = np.nonzero(mask)
+        layer_col.append(np.full(len(seq_pos), layer_idx))
+        pos_col.append(seq_pos)
+        value_col.append(layer_values[seq_pos, slots])
+        latent_col.append(layer_indices[seq_pos, slots])
+
+    columns = [np.concatenate(col).tolist() if col else [] for col in (layer_col, pos_col, value_col, latent_col)]
+    activations_list = [list(row) for row in zip(*columns)]
+
+    # Save as JSON
+    with open('activation_indices.json', 'w') as f:
+        json.dump(activations_list, f)
+    print(sequence)
+
+    print(f"Saved {len(activations_list)} activations to activation_indices.json")
+    print(f"Format: [layer, seq_pos, activation_value, latent_index]")
+
+if __name__ == "__main__":
+    main()
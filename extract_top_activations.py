@@ -1,20 +1,31 @@
 import torch
 import json
+import orjson
 
 top10_activations = torch.load('top10_activations.pt', weights_only=False)
 
 with open('IPR001478.json', 'r') as f:
     ipr_data = json.load(f)
 
-def convert_to_json(obj):
-    """Recursively convert PyTorch tensors and numpy arrays to JSON-serializable types."""
-    if hasattr(obj, 'tolist'):  # tensor/ndarray
+# Tensor dtypes whose numpy arrays orjson serializes natively
+NUMPY_NATIVE_DTYPES = {
+    torch.float64, torch.float32,
+    torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool,
+}
+
+def to_serializable(obj):
+    """
+    orjson fallback for whatever it can't serialize natively.
+    Contiguous >=1-d tensors of supported dtypes go through .numpy() (fast path);
+    anything else with tolist() (0-d or non-contiguous arrays, scalar/bf16 tensors) becomes Python lists/scalars.
+    """
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu()
+        if obj.dim() > 0 and obj.is_contiguous() and obj.dtype in NUMPY_NATIVE_DTYPES:
+            return obj.numpy()
+    if hasattr(obj, 'tolist'):
         return obj.tolist()
-    if isinstance(obj, dict):
-        return {str(k): convert_to_json(v) for k, v in obj.items()}
-    if isinstance(obj, (list, tuple)):
-        return [convert_to_json(x) for x in obj]
-    return obj
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
 # Build output structure
 output = {
@@ -22,15 +33,18 @@ output = {
     "layers": {}
 }
 
-# Extract activations for each layer and latent
+# Extract activations for each layer and latent (left as tensors/arrays for orjson)
 for layer, latent_ids in ipr_data['nodes'].items():
     output["layers"][layer] = {}
     for latent_id in latent_ids:
-        activations = top10_activations['storage'][int(layer)][latent_id]
-        output["layers"][layer][str(latent_id)] = convert_to_json(activations)
+        output["layers"][layer][str(latent_id)] = top10_activations['storage'][int(layer)][latent_id]
 
 # Write output
-with open('top_activations.json', 'w') as f:
-    json.dump(output, f, indent=2)
+with open('top_activations.json', 'wb') as f:
+    f.write(orjson.dumps(
+        output,
+        default=to_serializable,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2,
+    ))
 
-print("Saved to top_activations.json")
+print("Saved to top_activations.json")
\ No newline at end of file